@@ -1,11 +1,34 @@
 # app.py
+import asyncio
+import csv
+import hashlib
+import io
+import json
 import os
+import queue
+import re
+import threading
+import time
+import weakref
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import streamlit as st
 from dotenv import load_dotenv
 
-# CrewAI imports
-from crewai import Agent, Task, Crew
+import litellm
+
+# CrewAI imports (LLM is litellm-backed; stream chunks arrive on the event bus)
+from crewai import Agent, Task, Crew, LLM, Process
+from crewai.events import BaseEventListener, LLMStreamChunkEvent
+
+from prompts import (
+    BACKSTORIES,
+    COMPLIANCE_CHECKLIST_TEMPLATE,
+    DEBUG_BACKSTORIES,
+    GENERATE_TASK_TEMPLATE,
+    LETTER_TYPES,
+)
 
 # ----------------------------
 # Setup / Config
@@ -16,49 +39,160 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 DEFAULT_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 
+# Hot read/write paths (LLM cache, canonical instructions) live under
+# CACHE_DIR so containers can point it at a tmpfs mount and skip overlayfs
+# I/O entirely; locally it defaults to the working directory.
+CACHE_DIR = Path(os.getenv("CACHE_DIR", "."))
+
+_CANONICAL_FILENAME = "canonical_insurance_letter_instructions.txt"
+DEFAULT_INSTR_PATH = (
+    str(CACHE_DIR / _CANONICAL_FILENAME)
+    if (CACHE_DIR / _CANONICAL_FILENAME).exists()
+    else _CANONICAL_FILENAME
+)
+
 if not OPENAI_API_KEY:
     st.warning("Missing OPENAI_API_KEY. Set it in your environment or .env file.")
 
-# Some CrewAI versions use env var OPENAI_API_KEY directly.
-os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
+@st.cache_resource(show_spinner=False)
+def init_worker(api_key: str) -> None:
+    """
+    One-time per-worker setup, kept out of the rerun hot path.
+
+    Exports the API key (some CrewAI versions read OPENAI_API_KEY directly;
+    re-running putenv on every widget change is wasted work) and enables
+    litellm's global LLM cache, which CrewAI's LLM calls go through: repeat
+    generations with identical prompts — common given how many form fields
+    are defaulted — return from disk instead of re-hitting the API. For
+    multi-process deployments, swap type="disk" for litellm's Redis cache.
+    """
+    os.environ["OPENAI_API_KEY"] = api_key
+    litellm.cache = litellm.Cache(type="disk", disk_cache_dir=str(CACHE_DIR / ".litellm_cache"))
+
+
+init_worker(OPENAI_API_KEY)
+
+
+# Sentinel that closes a per-run token stream (see the run handler). The
+# queue itself is created per run: Streamlit module globals are shared across
+# every user session, so a global queue would interleave concurrent users'
+# letters into one stream.
+_STREAM_DONE = object()
+
+# CrewAI's event bus is process-global, so stream chunks from every session
+# and batch row land on the same listener. Each streaming run registers its
+# own LLM instance here; chunks are routed to that run's queue by emitting
+# source, and the weak keys let finished runs' entries vanish with their LLM.
+_STREAM_ROUTES = weakref.WeakKeyDictionary()
+
 
+class _TokenRoutingListener(BaseEventListener):
+    def setup_listeners(self, crewai_event_bus):
+        @crewai_event_bus.on(LLMStreamChunkEvent)
+        def _on_chunk(source, event):
+            token_queue = _STREAM_ROUTES.get(source)
+            if token_queue is not None:
+                token_queue.put(event.chunk)
 
-def load_canonical_instructions(path: str) -> str:
+
+_token_listener = _TokenRoutingListener()
+
+
+
+@st.cache_data(show_spinner=False)
+def _read_canonical_instructions(path: str, mtime: float) -> tuple:
+    # mtime is part of the cache key: editing the file invalidates the entry,
+    # otherwise every Streamlit rerun skips the disk read and decode. The
+    # preview slice is precomputed here so toggling the preview doesn't reslice.
+    text = Path(path).read_text(encoding="utf-8").rstrip()
+    return text, text[:6000]
+
+
+def load_canonical_instructions(path: str) -> tuple:
+    """
+    Return (full_text, preview) for the canonical instruction file.
+
+    rstrip keeps the text byte-identical across requests (no trailing-newline
+    drift), which provider prompt caching needs to recognize the prefix.
+    """
     p = Path(path)
     if not p.exists():
         raise FileNotFoundError(f"Canonical instruction file not found: {p.resolve()}")
-    return p.read_text(encoding="utf-8")
+    return _read_canonical_instructions(path, p.stat().st_mtime)
+
+
+@st.cache_data(show_spinner=False)
+def canonical_for_letter_type(canonical: str, letter_type: str) -> str:
+    """
+    Strip the canonical instructions down to what the chosen letter type needs:
+    common sections stay, `[For <type>]` variant blocks for the other letter
+    types are dropped. Prefill cost is linear in prompt length, so this trims
+    every Generator call; the result is still byte-stable per letter type, so
+    provider prefix caching keeps working (one cached prefix per type).
+    """
+    keep_tag = f"[For {letter_type}]"
+    other_tags = tuple(f"[For {t}]" for t in LETTER_TYPES if t != letter_type)
+    lines = []
+    skipping = False
+    for line in canonical.splitlines():
+        stripped = line.strip()
+        if stripped.startswith(other_tags):
+            # Variant block for another letter type: skip until the next
+            # variant tag, blank line, fence, or numbered section.
+            skipping = True
+            continue
+        if skipping and (
+            not stripped
+            or stripped.startswith(("```", keep_tag))
+            or stripped[:1].isdigit()
+        ):
+            skipping = False
+        if not skipping:
+            lines.append(line)
+    return "\n".join(lines).rstrip()
 
 
 # ----------------------------
 # UI
 # ----------------------------
 st.title("📄 Insurance Letter Generator (CrewAI)")
-st.caption("Uses your canonical instruction set + 3 agents (Generator → Formatter → Compliance).")
+st.caption("Uses your canonical instruction set + 2 agents (Generator → Compliance) with deterministic local formatting.")
 
 with st.sidebar:
     st.header("Settings")
-    model_name = st.text_input("Model", value=DEFAULT_MODEL)
+    generator_model = st.text_input("Generator model", value=DEFAULT_MODEL)
+    compliance_model = st.text_input("Compliance model", value=DEFAULT_MODEL)
     temperature = st.slider("Temperature", 0.0, 1.0, 0.2, 0.05)
+    verbose_agents = st.checkbox(
+        "Verbose agents",
+        value=False,
+        help="Opt-in CrewAI step logs. Off by default: trace rendering runs per LLM chunk and slows the server loop.",
+    )
 
     st.markdown("---")
     st.subheader("Canonical Instructions")
     instr_path = st.text_input(
         "Path to canonical .txt",
-        value="canonical_insurance_letter_instructions.txt",
+        value=DEFAULT_INSTR_PATH,
         help="Example: canonical_insurance_letter_instructions_20251228_074512.txt",
     )
 
     show_instructions = st.checkbox("Preview canonical instructions", value=False)
 
+    st.markdown("---")
+    st.subheader("Batch Mode")
+    batch_workers = st.slider(
+        "Max parallel letters",
+        min_value=1,
+        max_value=8,
+        value=4,
+        help="Concurrent pipeline runs in batch mode. Kickoffs are API-bound, so threads scale near-linearly up to rate limits.",
+    )
+
 col1, col2 = st.columns(2)
 
 with col1:
-    letter_type = st.selectbox(
-        "Letter Type",
-        ["Coverage Decision", "Denial Letter", "Request for Additional Information"],
-        index=1,
-    )
+    letter_type = st.selectbox("Letter Type", LETTER_TYPES, index=1)
     company_name = st.text_input("Company Name", value="Cascade Assurance")
     insured_name = st.text_input("Insured Name", value="Ananya Brown")
 
@@ -78,124 +212,351 @@ custom_notes = st.text_area(
 
 run_btn = st.button("🚀 Generate Letter", type="primary")
 
+st.markdown("---")
+st.subheader("📚 Batch Mode")
+batch_file = st.file_uploader(
+    "CSV with one letter per row",
+    type="csv",
+    help=(
+        "Columns: letter_type, company_name, insured_name, policy_number, "
+        "claim_number, contact_phone, response_deadline_days, custom_notes. "
+        "Missing columns fall back to the form values above."
+    ),
+)
+batch_col1, batch_col2 = st.columns(2)
+with batch_col1:
+    batch_btn = st.button("🚀 Generate Batch", disabled=batch_file is None)
+with batch_col2:
+    batch_api_btn = st.button(
+        "📦 Submit as Batch API job",
+        disabled=batch_file is None,
+        help="Offline processing via OpenAI's Batch API (24h window, discounted). For large overnight runs.",
+    )
+
 
 # ----------------------------
 # Crew Builder
 # ----------------------------
 @st.cache_resource(show_spinner=False)
-def build_agents(model: str, temp: float):
+def build_agents(gen_model: str, comp_model: str, temp: float, verbose: bool = False):
     """
-    Build agents once per model/temp combo.
+    Build agents once per model-combo/temp. Verbose runs swap in the long
+    backstories for easier prompt debugging.
     """
     generator = Agent(
         role="Insurance Letter Generator",
-        goal="Generate a complete insurance letter using canonical instructions and provided inputs.",
-        backstory=(
-            "You are a senior insurance correspondence specialist. "
-            "You strictly follow the canonical instruction set and produce clear, complete letters."
-        ),
-        llm=model,
-        verbose=True,
-    )
-
-    formatter = Agent(
-        role="Insurance Letter Formatter",
-        goal="Ensure the letter is cleanly formatted with consistent headings, spacing, and sections.",
-        backstory=(
-            "You are an expert in professional insurance document formatting. "
-            "You preserve content but improve structure and readability."
-        ),
-        llm=model,
-        verbose=True,
+        goal="Generate a complete insurance letter from the canonical instructions.",
+        backstory=DEBUG_BACKSTORIES["generator"] if verbose else BACKSTORIES["generator"],
+        # No stream=True here: these agents are cached and shared, so
+        # run_pipeline swaps in a per-run streaming LLM on its Crew copy.
+        llm=LLM(model=gen_model, temperature=temp),
+        verbose=verbose,
     )
 
     compliance = Agent(
         role="Insurance Compliance Reviewer",
-        goal="Ensure the letter includes required compliance/regulatory language and correct references.",
-        backstory=(
-            "You are an insurance compliance officer. "
-            "You check for regulatory notice, appeal rights, timelines, and that identifiers are present."
-        ),
-        llm=model,
-        verbose=True,
+        goal="Verify required compliance language, identifiers, and deadlines are present.",
+        backstory=DEBUG_BACKSTORIES["compliance"] if verbose else BACKSTORIES["compliance"],
+        llm=LLM(model=comp_model, temperature=temp),
+        verbose=verbose,
     )
 
-    return generator, formatter, compliance
+    return generator, compliance
 
 
-def build_crew(canonical_instructions: str, model: str, temp: float):
-    # NOTE: temperature is managed by your LLM configuration; CrewAI 'llm' accepts model string in many setups.
-    # If your CrewAI version supports passing an LLM object, you can wire temperature there.
-    generator_agent, formatter_agent, compliance_agent = build_agents(model, temp)
+@st.cache_resource(show_spinner=False)
+def build_letter_crew(canonical_hash: str, _canonical_instructions: str, models: tuple, temp: float, verbose: bool = False):
+    # canonical_hash is the cache key for the instruction text; the underscore
+    # on _canonical_instructions tells Streamlit not to hash the full blob.
+    canonical_instructions = _canonical_instructions
+    generator_agent, compliance_agent = build_agents(*models, temp, verbose)
 
     generate_task = Task(
-        description=(
-            "You MUST follow the canonical instruction set below.\n\n"
-            "CANONICAL INSTRUCTIONS:\n"
-            f"{canonical_instructions}\n\n"
-            "INPUTS:\n"
-            "- Letter Type: {letter_type}\n"
-            "- Company Name: {company_name}\n"
-            "- Insured Name: {insured_name}\n"
-            "- Policy Number: {policy_number}\n"
-            "- Claim Number: {claim_number}\n"
-            "- Claims Dept Phone: {contact_phone}\n"
-            "- Response Deadline (days): {response_deadline_days}\n"
-            "- Additional Notes: {custom_notes}\n\n"
-            "TASK:\n"
-            "Generate a complete insurance letter with required sections, placeholders resolved, "
-            "and type-specific content. Include compliance/regulatory notice per canonical instructions."
-        ),
+        # The canonical blob comes first, bit-identical across requests, so
+        # provider prompt caching (OpenAI automatic prefix caching, Anthropic
+        # cache_control) can reuse the prefill for this large static prefix.
+        description=GENERATE_TASK_TEMPLATE.replace("{canonical_instructions}", canonical_instructions),
         expected_output="A complete insurance letter draft (raw draft).",
         agent=generator_agent,
-    )
-
-    format_task = Task(
-        description=(
-            "Take the previous draft and format it professionally.\n"
-            "Requirements:\n"
-            "- Clear header block (company/address/date if required)\n"
-            "- Subject line\n"
-            "- Section headings and separators\n"
-            "- Consistent spacing\n"
-            "- Keep all content; do not remove compliance language.\n"
-            "Return the formatted letter only."
-        ),
-        expected_output="A professionally formatted insurance letter.",
-        agent=formatter_agent,
+        # No output_pydantic here: CrewAI would either make the Generator
+        # answer in JSON (streamed raw to the UI) or spend an extra converter
+        # LLM call. context=[generate_task] below already scopes the handoff.
     )
 
     compliance_task = Task(
         description=(
-            "Review the formatted letter for compliance.\n"
-            "Checklist:\n"
-            "- Company name, policy number, claim number present\n"
-            "- Correct letter type cues present\n"
-            "- Compliance/regulatory notice present\n"
-            "- Appeal/reconsideration language present when applicable\n"
-            f"- Mentions response deadline of { { 'response_deadline_days' } } days and contact phone\n\n"
-            "If anything is missing or weak, add/strengthen it while staying professional.\n"
-            "Return ONLY the final compliant letter."
+            "Review the draft letter from the previous task for compliance.\n\n"
+            + COMPLIANCE_CHECKLIST_TEMPLATE
         ),
-        expected_output="A final compliant insurance letter.",
+        expected_output="'NO CHANGES', or compliance paragraphs to insert into the letter.",
         agent=compliance_agent,
+        # Explicit context instead of CrewAI's default "all previous tasks":
+        # only the Generator's draft feeds the Compliance prompt.
+        context=[generate_task],
     )
 
     return Crew(
-        agents=[generator_agent, formatter_agent, compliance_agent],
-        tasks=[generate_task, format_task, compliance_task],
-        verbose=True,
+        agents=[generator_agent, compliance_agent],
+        tasks=[generate_task, compliance_task],
+        process=Process.sequential,
+        verbose=verbose,
     )
 
 
+def format_letter(raw: str, inputs: dict) -> str:
+    """
+    Deterministic replacement for the old Formatter agent. Header block,
+    subject line, and whitespace normalization are template-mechanical, so a
+    local pass does them in microseconds instead of an LLM round-trip.
+    """
+    letter = re.sub(r"\n{3,}", "\n\n", raw.strip())
+
+    # Ensure a subject line; insert it before the salutation if missing.
+    if not re.search(r"(?mi)^\s*subject\s*:", letter):
+        subject = (
+            f"Subject: {inputs['letter_type']} - "
+            f"Policy {inputs['policy_number']} / Claim {inputs['claim_number']}"
+        )
+        m = re.search(r"(?mi)^\s*dear\b", letter)
+        if m:
+            letter = letter[: m.start()] + subject + "\n\n" + letter[m.start():]
+        else:
+            letter = subject + "\n\n" + letter
+
+    # Ensure the header block (company name + date) opens the letter.
+    if not letter.lstrip().startswith(inputs["company_name"]):
+        letter = f"{inputs['company_name']}\n{date.today():%B %d, %Y}\n\n" + letter
+
+    return letter + "\n"
+
+
+def merge_format_and_compliance(formatted: str, compliance_notes: str) -> str:
+    """
+    Merge the Compliance notes into the formatted letter: the letter is the
+    base, and any compliance additions are inserted before the closing block.
+    """
+    notes = compliance_notes.strip()
+    if not notes or notes.upper().startswith("NO CHANGES"):
+        return formatted
+
+    lines = formatted.rstrip().splitlines()
+    # Insert additions before the sign-off if we can find one, else append.
+    for i, line in enumerate(lines):
+        if line.strip().lower().startswith(("sincerely", "regards", "best regards")):
+            return "\n".join(lines[:i] + [notes, ""] + lines[i:])
+    return formatted.rstrip() + "\n\n" + notes + "\n"
+
+
+def run_pipeline(canonical_instructions: str, models: tuple, temp: float, inputs: dict,
+                 verbose: bool = False, token_queue: queue.Queue = None) -> str:
+    """
+    One sequential Crew runs Generator → Compliance with a minimal structured
+    handoff between them; a deterministic local pass then formats the draft and
+    merges the Compliance notes in. Two LLM round-trips per letter.
+
+    When token_queue is given, this run's Generator tokens and stage events are
+    pushed into it for the UI; batch rows pass None and stream nothing.
+    """
+    # Only the Generator sees canonical text, trimmed to the chosen letter
+    # type; the Compliance critic works from the draft handoff alone.
+    canonical = canonical_for_letter_type(canonical_instructions, inputs["letter_type"])
+    canonical_hash = hashlib.sha1(canonical.encode()).hexdigest()
+    # The cached Crew is a shared template: kickoff interpolates inputs into
+    # the Task descriptions and stores outputs on the Task objects, so
+    # concurrent batch rows must each run on their own copy (the same thing
+    # CrewAI's kickoff_for_each does internally).
+    crew = build_letter_crew(canonical_hash, canonical, models, temp, verbose).copy()
+    if token_queue is not None:
+        # Streaming is wired to the per-run copy only — a streaming LLM baked
+        # into the cached agents would broadcast one session's letter to
+        # everyone. _STREAM_ROUTES maps this LLM's chunks to this run's queue.
+        stream_llm = LLM(model=models[0], temperature=temp, stream=True)
+        _STREAM_ROUTES[stream_llm] = token_queue
+        crew.tasks[0].agent.llm = stream_llm
+        crew.task_callback = lambda task_output: token_queue.put(
+            ("stage", f"✔ {getattr(task_output, 'agent', 'stage')} finished")
+        )
+    # kickoff_async keeps the kickoff off the calling thread's blocking path;
+    # each pipeline invocation runs in its own short-lived event loop.
+    result = asyncio.run(crew.kickoff_async(inputs=inputs))
+
+    draft = result.tasks_output[0].raw
+    formatted = format_letter(draft, inputs)
+
+    return merge_format_and_compliance(formatted, str(result))
+
+
+def normalize_inputs(inputs: dict) -> tuple:
+    """
+    Canonicalize inputs into a hashable cache key: casing and stray whitespace
+    don't change the letter being asked for, so they shouldn't force a fresh
+    generation.
+    """
+    norm = {}
+    for k, v in inputs.items():
+        if isinstance(v, str):
+            v = " ".join(v.split()).lower()
+        norm[k] = v
+    return tuple(sorted(norm.items()))
+
+
+@st.cache_data(ttl=3600, max_entries=500, show_spinner=False)
+def cached_generate(canonical_hash: str, inputs_norm: tuple, models: tuple, temp: float,
+                    verbose: bool, _canonical: str, _inputs: dict,
+                    _token_queue: queue.Queue = None) -> str:
+    """
+    Application-level response cache over the whole pipeline, keyed on the
+    normalized inputs (plus canonical hash, models, temperature, and verbose —
+    verbose swaps in the debug backstories, so it changes the letter). Hits
+    return the final letter without any API traffic; misses run the Crew and
+    store the result for an hour.
+    """
+    return run_pipeline(_canonical, models, temp, _inputs, verbose, _token_queue)
+
+
+def run_pipeline_with_retry(canonical_instructions: str, models: tuple, temp: float, inputs: dict, verbose: bool = False, attempts: int = 3) -> str:
+    """
+    Retry wrapper for batch runs: provider 429s/timeouts are transient, so back
+    off exponentially instead of failing the whole batch.
+    """
+    for attempt in range(attempts):
+        try:
+            return run_pipeline(canonical_instructions, models, temp, inputs, verbose)
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+
+def run_batch(canonical_instructions: str, models: tuple, temp: float, inputs_list: list, max_workers: int, verbose: bool = False) -> list:
+    """
+    Run one pipeline per input dict concurrently. Kickoffs are I/O-bound on the
+    OpenAI API, so thread-level concurrency gives near-linear speedup up to
+    provider rate limits.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(
+            pool.map(
+                lambda row: run_pipeline_with_retry(canonical_instructions, models, temp, row, verbose),
+                inputs_list,
+            )
+        )
+
+
+# ----------------------------
+# Offline Batch API
+# ----------------------------
+# For large overnight runs (thousands of letters) the synchronous API pays full
+# latency per call; OpenAI's Batch API trades a 24h completion window for
+# discounted, high-throughput processing. The two LLM stages are submitted as
+# two consecutive batches, with the deterministic formatter and note merge
+# applied locally in between.
+@st.cache_resource(show_spinner=False)
+def _openai_client():
+    from openai import OpenAI
+
+    return OpenAI()
+
+
+def _create_batch(lines: list) -> str:
+    client = _openai_client()
+    upload = client.files.create(
+        file=("batch.jsonl", io.BytesIO("\n".join(lines).encode("utf-8"))),
+        purpose="batch",
+    )
+    batch = client.batches.create(
+        input_file_id=upload.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    return batch.id
+
+
+def submit_generator_batch(canonical_instructions: str, inputs_list: list, model: str, temp: float) -> str:
+    lines = []
+    for i, inputs in enumerate(inputs_list):
+        canonical = canonical_for_letter_type(canonical_instructions, inputs["letter_type"])
+        prompt = GENERATE_TASK_TEMPLATE.replace("{canonical_instructions}", canonical).format(**inputs)
+        lines.append(
+            json.dumps(
+                {
+                    "custom_id": f"letter-{i}",
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": model,
+                        "temperature": temp,
+                        "messages": [
+                            {"role": "system", "content": BACKSTORIES["generator"]},
+                            {"role": "user", "content": prompt},
+                        ],
+                    },
+                }
+            )
+        )
+    return _create_batch(lines)
+
+
+def submit_compliance_batch(drafts: list, inputs_list: list, model: str, temp: float) -> str:
+    lines = []
+    for i, (draft, inputs) in enumerate(zip(drafts, inputs_list)):
+        prompt = (
+            "Review the draft letter below for compliance.\n\n"
+            f"DRAFT:\n{draft}\n\n" + COMPLIANCE_CHECKLIST_TEMPLATE.format(**inputs)
+        )
+        lines.append(
+            json.dumps(
+                {
+                    "custom_id": f"letter-{i}",
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": model,
+                        "temperature": temp,
+                        "messages": [
+                            {"role": "system", "content": BACKSTORIES["compliance"]},
+                            {"role": "user", "content": prompt},
+                        ],
+                    },
+                }
+            )
+        )
+    return _create_batch(lines)
+
+
+def fetch_batch_results(batch_id: str):
+    """
+    Return (status, results): results is a {custom_id: completion_text} dict
+    once the batch has completed, otherwise None.
+    """
+    client = _openai_client()
+    batch = client.batches.retrieve(batch_id)
+    if batch.status != "completed":
+        return batch.status, None
+    raw = client.files.content(batch.output_file_id).text
+    results = {}
+    for line in raw.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        custom_id = item.get("custom_id")
+        # Failed sub-requests come back with a null response; skip them so
+        # one bad row doesn't take down the whole batch.
+        choices = ((item.get("response") or {}).get("body") or {}).get("choices") or []
+        if not custom_id or not choices:
+            continue
+        results[custom_id] = choices[0]["message"]["content"]
+    return batch.status, results
+
+
 # ----------------------------
 # Preview Canonical Instructions
 # ----------------------------
 if show_instructions:
     try:
-        canon = load_canonical_instructions(instr_path)
+        canon, canon_preview = load_canonical_instructions(instr_path)
         st.subheader("Canonical Instructions Preview")
-        st.code(canon[:6000] + ("\n...\n" if len(canon) > 6000 else ""), language="text")
+        st.code(canon_preview + ("\n...\n" if len(canon) > 6000 else ""), language="text")
     except Exception as e:
         st.error(str(e))
 
@@ -205,7 +566,7 @@ if show_instructions:
 # ----------------------------
 if run_btn:
     try:
-        canonical = load_canonical_instructions(instr_path)
+        canonical, _ = load_canonical_instructions(instr_path)
     except Exception as e:
         st.error(f"Could not load canonical instructions: {e}")
         st.stop()
@@ -221,20 +582,225 @@ if run_btn:
         "custom_notes": custom_notes.strip() or "None",
     }
 
-    with st.spinner("Running CrewAI agents (Generator → Formatter → Compliance)..."):
-        crew = build_crew(canonical, model_name, temperature)
-        result = crew.kickoff(inputs=inputs)
+    # Fresh queue per run: nothing leaks between runs or between sessions.
+    token_queue: queue.Queue = queue.Queue()
+    result_box: dict = {}
+
+    def _worker():
+        try:
+            result_box["letter"] = cached_generate(
+                hashlib.sha1(canonical.encode()).hexdigest(),
+                normalize_inputs(inputs),
+                (generator_model, compliance_model),
+                temperature,
+                verbose_agents,
+                canonical,
+                inputs,
+                token_queue,
+            )
+        except Exception as e:  # surfaced on the main thread below
+            result_box["error"] = e
+        finally:
+            token_queue.put(_STREAM_DONE)
+
+    status_box = st.empty()
+    status_box.write("⏳ Generator drafting...")
+
+    def _drain_tokens():
+        while True:
+            item = token_queue.get()
+            if item is _STREAM_DONE:
+                return
+            if isinstance(item, tuple) and item[0] == "stage":
+                status_box.write(item[1])
+                continue
+            yield item
+
+    worker = threading.Thread(target=_worker, daemon=True)
+    worker.start()
 
-    st.success("Done!")
     st.subheader("✅ Final Letter")
-    st.text_area("Final Output", value=str(result), height=500)
+    stream_area = st.empty()
+    with stream_area.container():
+        st.write_stream(_drain_tokens())
+    worker.join()
+    status_box.empty()
+
+    if "error" in result_box:
+        st.error(f"Generation failed: {result_box['error']}")
+        st.stop()
+
+    result = result_box["letter"]
+    # The stream showed the Generator's raw draft; replace it with the final
+    # formatted + compliance-merged letter (also covers cache hits, where no
+    # tokens were streamed at all).
+    stream_area.code(str(result), language="markdown")
+    st.success("Done!")
 
-    # Download button
+    # Encode the download payload once; later reruns (any widget change) render
+    # the button straight from session state without re-encoding.
+    st.session_state["last_letter"] = str(result)
+    st.session_state["last_letter_bytes"] = str(result).encode("utf-8")
+    st.session_state["last_letter_name"] = (
+        f"{letter_type.replace(' ', '_').lower()}_{policy_number}_{claim_number}.txt"
+    )
+
+if "last_letter" in st.session_state and not run_btn:
+    # Re-render the last letter on ordinary reruns as a read-only code block:
+    # unlike a text_area widget, st.code doesn't round-trip its full value
+    # over the websocket on every interaction. Editing stays opt-in.
+    st.subheader("✅ Final Letter")
+    if st.toggle("✏️ Edit letter", value=False):
+        edited = st.text_area("Edit final letter", value=st.session_state["last_letter"], height=500)
+        st.session_state["last_letter"] = edited
+        st.session_state["last_letter_bytes"] = edited.encode("utf-8")
+    else:
+        st.code(st.session_state["last_letter"], language="markdown")
+
+if "last_letter_bytes" in st.session_state:
     st.download_button(
         "⬇️ Download letter as .txt",
-        data=str(result).encode("utf-8"),
-        file_name=f"{letter_type.replace(' ', '_').lower()}_{policy_number}_{claim_number}.txt",
+        data=st.session_state["last_letter_bytes"],
+        file_name=st.session_state["last_letter_name"],
         mime="text/plain",
     )
 
+def parse_batch_csv(uploaded) -> list:
+    """Turn the uploaded CSV into input dicts, form values filling any gaps."""
+    reader = csv.DictReader(io.StringIO(uploaded.getvalue().decode("utf-8")))
+    inputs_list = []
+    for row in reader:
+        try:
+            deadline = int(row.get("response_deadline_days") or response_deadline_days)
+        except ValueError:
+            deadline = int(response_deadline_days)
+        inputs_list.append(
+            {
+                "letter_type": (row.get("letter_type") or letter_type).strip(),
+                "company_name": (row.get("company_name") or company_name).strip(),
+                "insured_name": (row.get("insured_name") or insured_name).strip(),
+                "policy_number": (row.get("policy_number") or policy_number).strip(),
+                "claim_number": (row.get("claim_number") or claim_number).strip(),
+                "contact_phone": (row.get("contact_phone") or contact_phone).strip() or "N/A",
+                "response_deadline_days": deadline,
+                "custom_notes": (row.get("custom_notes") or custom_notes).strip() or "None",
+            }
+        )
+    return inputs_list
+
+
+def letters_to_csv(inputs_list: list, letters: list) -> bytes:
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["letter_type", "policy_number", "claim_number", "letter"])
+    for row_inputs, letter in zip(inputs_list, letters):
+        writer.writerow(
+            [row_inputs["letter_type"], row_inputs["policy_number"], row_inputs["claim_number"], letter]
+        )
+    return out.getvalue().encode("utf-8")
+
+
+if batch_btn and batch_file is not None:
+    try:
+        canonical, _ = load_canonical_instructions(instr_path)
+    except Exception as e:
+        st.error(f"Could not load canonical instructions: {e}")
+        st.stop()
+
+    inputs_list = parse_batch_csv(batch_file)
+    if not inputs_list:
+        st.error("The uploaded CSV has no data rows.")
+        st.stop()
+
+    with st.spinner(f"Generating {len(inputs_list)} letters ({batch_workers} in parallel)..."):
+        letters = run_batch(
+            canonical,
+            (generator_model, compliance_model),
+            temperature,
+            inputs_list,
+            batch_workers,
+            verbose_agents,
+        )
+
+    st.success(f"Generated {len(letters)} letters.")
+    st.download_button(
+        "⬇️ Download batch results as .csv",
+        data=letters_to_csv(inputs_list, letters),
+        file_name="generated_letters.csv",
+        mime="text/csv",
+    )
+    with st.expander("Preview first letter"):
+        st.text(letters[0])
+
+if batch_api_btn and batch_file is not None:
+    try:
+        canonical, _ = load_canonical_instructions(instr_path)
+    except Exception as e:
+        st.error(f"Could not load canonical instructions: {e}")
+        st.stop()
+
+    inputs_list = parse_batch_csv(batch_file)
+    if not inputs_list:
+        st.error("The uploaded CSV has no data rows.")
+        st.stop()
+
+    batch_id = submit_generator_batch(canonical, inputs_list, generator_model, temperature)
+    st.session_state["batch_job"] = {"stage": "generate", "id": batch_id, "inputs": inputs_list}
+    st.success(f"Submitted Generator batch {batch_id} ({len(inputs_list)} letters, 24h window).")
+
+if "batch_job" in st.session_state:
+    job = st.session_state["batch_job"]
+    st.info(f"Batch API job {job['id']} — stage: {job['stage']}")
+    if st.button("🔄 Check batch status"):
+        status, results = fetch_batch_results(job["id"])
+        if results is None:
+            if status in ("failed", "expired", "cancelled"):
+                st.error(f"Batch {job['id']} ended with status '{status}' — job abandoned.")
+                del st.session_state["batch_job"]
+            else:
+                st.info(f"Batch {job['id']} status: {status}")
+        elif job["stage"] == "generate":
+            # Stage 1 done: format the drafts locally and submit the
+            # Compliance review as a second batch. Rows whose sub-request
+            # failed have no result; drop them rather than wedge the job.
+            kept = [
+                (i, inputs)
+                for i, inputs in enumerate(job["inputs"])
+                if f"letter-{i}" in results
+            ]
+            if len(kept) < len(job["inputs"]):
+                st.warning(f"{len(job['inputs']) - len(kept)} row(s) failed in the Generator batch and were skipped.")
+            if not kept:
+                st.error("All rows failed in the Generator batch — job abandoned.")
+                del st.session_state["batch_job"]
+                st.stop()
+            drafts = [format_letter(results[f"letter-{i}"], inputs) for i, inputs in kept]
+            kept_inputs = [inputs for _, inputs in kept]
+            comp_id = submit_compliance_batch(drafts, kept_inputs, compliance_model, temperature)
+            st.session_state["batch_job"] = {
+                "stage": "compliance",
+                "id": comp_id,
+                "inputs": kept_inputs,
+                "drafts": drafts,
+            }
+            st.success(f"Generator stage complete — submitted Compliance batch {comp_id}.")
+        else:
+            # Rows whose compliance review failed fall back to the formatted
+            # draft instead of crashing the whole job.
+            missing = [i for i in range(len(job["drafts"])) if f"letter-{i}" not in results]
+            if missing:
+                st.warning(f"{len(missing)} row(s) failed compliance review; their formatted drafts are used as-is.")
+            letters = [
+                merge_format_and_compliance(draft, results[f"letter-{i}"]) if f"letter-{i}" in results else draft
+                for i, draft in enumerate(job["drafts"])
+            ]
+            st.success(f"Batch complete: {len(letters)} letters.")
+            st.download_button(
+                "⬇️ Download batch results as .csv",
+                data=letters_to_csv(job["inputs"], letters),
+                file_name="generated_letters.csv",
+                mime="text/csv",
+            )
+            del st.session_state["batch_job"]
+
 st.markdown("---")
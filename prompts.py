@@ -0,0 +1,58 @@
+# prompts.py
+# Prompt text shared by the interactive Crew and the offline Batch API path.
+# Deliberately dependency-free so the templates can be unit-tested without
+# streamlit/crewai installed.
+
+LETTER_TYPES = ["Coverage Decision", "Denial Letter", "Request for Additional Information"]
+
+# The full-sentence backstories, kept for verbose/debug runs. CrewAI folds
+# goal + backstory into the system prompt of every LLM call, so the default
+# build uses condensed one-liners to cut prefill tokens on each task.
+DEBUG_BACKSTORIES = {
+    "generator": (
+        "You are a senior insurance correspondence specialist. "
+        "You strictly follow the canonical instruction set and produce clear, complete letters."
+    ),
+    "compliance": (
+        "You are an insurance compliance officer. "
+        "You check for regulatory notice, appeal rights, timelines, and that identifiers are present."
+    ),
+}
+
+BACKSTORIES = {
+    "generator": "Senior insurance correspondence specialist; follows the canonical spec strictly.",
+    "compliance": "Insurance compliance officer; checks notices, appeal rights, and identifiers.",
+}
+
+# {canonical_instructions} is substituted at build time (str.replace, since
+# the canonical text is prose); the other placeholders resolve per letter
+# (CrewAI inputs= or str.format for batches).
+GENERATE_TASK_TEMPLATE = (
+    "CANONICAL INSTRUCTIONS:\n"
+    "{canonical_instructions}\n\n"
+    "You MUST follow the canonical instruction set above.\n\n"
+    "INPUTS:\n"
+    "- Letter Type: {letter_type}\n"
+    "- Company Name: {company_name}\n"
+    "- Insured Name: {insured_name}\n"
+    "- Policy Number: {policy_number}\n"
+    "- Claim Number: {claim_number}\n"
+    "- Claims Dept Phone: {contact_phone}\n"
+    "- Response Deadline (days): {response_deadline_days}\n"
+    "- Additional Notes: {custom_notes}\n\n"
+    "TASK:\n"
+    "Generate a complete insurance letter with required sections, placeholders resolved, "
+    "and type-specific content. Include compliance/regulatory notice per canonical instructions."
+)
+
+COMPLIANCE_CHECKLIST_TEMPLATE = (
+    "Checklist:\n"
+    "- Company name, policy number, claim number present\n"
+    "- Correct letter type cues present\n"
+    "- Compliance/regulatory notice present\n"
+    "- Appeal/reconsideration language present when applicable\n"
+    "- Mentions response deadline of {response_deadline_days} days and contact phone {contact_phone}\n\n"
+    "If every item is satisfied, return ONLY the text 'NO CHANGES'.\n"
+    "Otherwise return ONLY the missing or strengthened compliance paragraphs, "
+    "written so they can be inserted into the letter verbatim."
+)
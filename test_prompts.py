@@ -0,0 +1,47 @@
+# test_prompts.py
+# Pure string tests for the shared prompt templates — no streamlit/crewai
+# needed, so they run anywhere (`python -m pytest -q test_prompts.py`).
+import re
+
+from prompts import COMPLIANCE_CHECKLIST_TEMPLATE, GENERATE_TASK_TEMPLATE, LETTER_TYPES
+
+SAMPLE_CANONICAL = (
+    "1. **Opening**: State the claim decision clearly.\n"
+    "[For Denial Letter] Include the specific denial reason.\n"
+    "2. **Closing**: Provide appeal rights and contact information.\n"
+)
+
+SAMPLE_INPUTS = {
+    "letter_type": LETTER_TYPES[1],
+    "company_name": "Acme Insurance",
+    "insured_name": "Jordan Smith",
+    "policy_number": "POL-123456",
+    "claim_number": "CLM-789",
+    "contact_phone": "(555) 010-0199",
+    "response_deadline_days": 30,
+    "custom_notes": "Water damage claim.",
+}
+
+
+def test_generate_template_resolves_all_placeholders():
+    prompt = GENERATE_TASK_TEMPLATE.replace(
+        "{canonical_instructions}", SAMPLE_CANONICAL
+    ).format(**SAMPLE_INPUTS)
+    assert not re.search(r"\{\w+\}", prompt)
+    for value in SAMPLE_INPUTS.values():
+        assert str(value) in prompt
+
+
+def test_compliance_template_resolves_all_placeholders():
+    prompt = COMPLIANCE_CHECKLIST_TEMPLATE.format(**SAMPLE_INPUTS)
+    assert not re.search(r"\{\w+\}", prompt)
+    assert "30" in prompt
+    assert "(555) 010-0199" in prompt
+
+
+def test_generate_template_needs_only_the_documented_inputs():
+    # str.format raises KeyError if the template grows a placeholder that the
+    # UI / batch CSV doesn't supply — this pins the contract.
+    body = GENERATE_TASK_TEMPLATE.replace("{canonical_instructions}", "")
+    placeholders = set(re.findall(r"\{(\w+)\}", body))
+    assert placeholders == set(SAMPLE_INPUTS)